@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
-import os
+import base64, hashlib, hmac
 from flask import Flask, request, abort
-from dotenv import load_dotenv
 
 # ---- line-bot-sdk v3 版 imports ----
 from linebot.v3.webhook import WebhookHandler
@@ -12,38 +11,52 @@ from linebot.v3.messaging import (
 )
 from linebot.v3.exceptions import InvalidSignatureError
 
-# 讀取 .env（需包含 CHANNEL_SECRET / CHANNEL_ACCESS_TOKEN）
-load_dotenv()
-CHANNEL_SECRET = os.getenv("CHANNEL_SECRET")
-CHANNEL_ACCESS_TOKEN = os.getenv("CHANNEL_ACCESS_TOKEN")
+# 讀取 .env（需包含 CHANNEL_SECRET / CHANNEL_ACCESS_TOKEN），與 app.py 共用 config.py
+from config import CHANNEL_SECRET, CHANNEL_ACCESS_TOKEN, SECRET_BYTES
 if not CHANNEL_SECRET or not CHANNEL_ACCESS_TOKEN:
     print("請確認 .env 的 CHANNEL_SECRET / CHANNEL_ACCESS_TOKEN 設定正確")
     raise SystemExit(1)
 
 # 建立 Flask
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = 256 * 1024  # 擋掉超大請求
+
+# ---- 額外加入的檢查路由（內容固定，先編好 bytes）----
+INDEX_BODY = b"LINE bot running. Try /health or set /callback as your Webhook URL."
+HEALTH_BODY = b"ok"
 
-# ---- 額外加入的檢查路由 ----
 @app.route("/")
 def index():
-    return "LINE bot running. Try /health or set /callback as your Webhook URL.", 200
+    return INDEX_BODY, 200
 
 @app.route("/health")
 def health():
-    return "ok", 200
+    return HEALTH_BODY, 200
 
 # ---- v3：建立 Handler 與 Messaging API 設定 ----
 handler = WebhookHandler(CHANNEL_SECRET)
+# 簽章用的 HMAC 先帶好金鑰，每次請求 copy() 即可
+hmac_base = hmac.new(SECRET_BYTES, digestmod=hashlib.sha256)
 configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
+configuration.connection_pool_maxsize = 20
+# 共用同一個 ApiClient，回覆時沿用 keep-alive 連線
+api_client = ApiClient(configuration)
+messaging_api = MessagingApi(api_client)
 
 # ---- Webhook 入口：給 LINE 伺服器呼叫 ----
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers.get('X-Line-Signature', '')
-    body = request.get_data(as_text=True)
+    raw = request.get_data(cache=False)
+
+    # 先以常數時間比對簽章，偽造請求不必進 SDK 解析
+    mac = hmac_base.copy()
+    mac.update(raw)
+    if not hmac.compare_digest(base64.b64encode(mac.digest()), signature.encode('utf-8')):
+        abort(400)
 
     try:
-        handler.handle(body, signature)
+        handler.handle(raw.decode('utf-8'), signature)
     except InvalidSignatureError:
         # 簽章不正確，多半是 CHANNEL_SECRET 不匹配
         abort(400)
@@ -56,15 +69,13 @@ def handle_message(event: MessageEvent):
     user_text = (event.message.text or "").strip()
     reply_text = f"你剛剛說：{user_text}\n準備好玩狼人殺了嗎？"
 
-    # 用 ApiClient + MessagingApi 回覆
-    with ApiClient(configuration) as api_client:
-        messaging_api = MessagingApi(api_client)
-        messaging_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=reply_text)]
-            )
+    # 用共用的 MessagingApi 回覆
+    messaging_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=reply_text)]
         )
+    )
 
 if __name__ == "__main__":
     # 本機測試：python FlaskWebhook.py
@@ -1,30 +1,27 @@
 # -*- coding: utf-8 -*-
-import os, random, threading
-from collections import Counter
-from datetime import datetime, timedelta, timezone
+import os, re, json, atexit, functools, heapq, itertools, random, threading, time, base64, hashlib, hmac
+from collections import Counter, deque
+from itertools import takewhile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from enum import StrEnum
 from flask import Flask, request, abort
 
-# ===== 可選：載入 Render Secret Files 的 .env =====
-SECRET_FILE_PATH = "/etc/secrets/.env"  # 若未使用可忽略；如有不同路徑請修改
-try:
-    if os.path.exists(SECRET_FILE_PATH):
-        from dotenv import load_dotenv
-        load_dotenv(SECRET_FILE_PATH)
-    else:
-        # 環境變數若已在 Render → Environment 設定，這段可省略
-        from dotenv import load_dotenv
-        load_dotenv()
-except Exception:
-    pass  # 不因 dotenv 失敗而終止
+# ===== 環境設定（.env 載入集中在 config.py）=====
+from config import CHANNEL_SECRET, CHANNEL_ACCESS_TOKEN, SECRET_BYTES
+# 啟動時檢查一次就好，不放在請求路徑上；缺值仍照常啟動（webhook 會一律回 400／無法回覆）
+if not (CHANNEL_SECRET and CHANNEL_ACCESS_TOKEN):
+    print("[BOOT] 未設定 CHANNEL_SECRET / CHANNEL_ACCESS_TOKEN，webhook 無法驗證或回覆")
 
 # ===== LINE v3 SDK（啟動期不讓它造成崩潰）=====
 LINE_READY = True
 try:
-    from linebot.v3.webhook import WebhookHandler
+    from linebot.v3.webhook import WebhookParser
     from linebot.v3.webhooks import MessageEvent, TextMessageContent
     from linebot.v3.messaging import (
         MessagingApi, Configuration, ApiClient,
-        ReplyMessageRequest, PushMessageRequest, TextMessage
+        ReplyMessageRequest, PushMessageRequest, MulticastRequest, TextMessage,
+        ApiException
     )
     from linebot.v3.exceptions import InvalidSignatureError
 except Exception as e:
@@ -32,32 +29,93 @@ except Exception as e:
     # 後續會記 log，但不終止 app
     print(f"[BOOT] line-bot-sdk v3 未就緒：{e}")
 
-CHANNEL_SECRET = os.getenv("CHANNEL_SECRET")
-CHANNEL_ACCESS_TOKEN = os.getenv("CHANNEL_ACCESS_TOKEN")
-
-# ===== APScheduler 可選；無則改用 threading.Timer =====
-USE_APS = True
-try:
-    from apscheduler.schedulers.background import BackgroundScheduler
-except Exception as e:
-    USE_APS = False
-    print(f"[BOOT] apscheduler 未安裝，將使用簡易排程器：{e}")
+# ===== Redis 可選；設定 REDIS_URL 才把房間寫回 Redis（重啟不丟局；redis 套件已列在 requirements.txt）=====
+REDIS_URL = os.getenv("REDIS_URL")
+_REDIS = None
+if REDIS_URL:
+    try:
+        import redis
+        _REDIS = redis.Redis.from_url(REDIS_URL)
+        _REDIS.ping()
+    except Exception as e:
+        _REDIS = None
+        print(f"[BOOT] Redis 無法使用，房間只存在記憶體：{e}")
 
 # ============== Flask App ==============
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = 256 * 1024  # LINE webhook 很小；超大請求由 Flask 直接 413
+
+# ===== 共用 LINE API 連線（整個行程共用一個 urllib3 連線池，走 keep-alive）=====
+# webhook 背景 8 條（WEBHOOK_EXECUTOR）+ 背景推送 16 條（EXECUTOR），都能各自握住一條 keep-alive 連線
+LINE_POOL_MAXSIZE = 32
+_API_CLIENT = None
+_MESSAGING = None
+if LINE_READY and CHANNEL_ACCESS_TOKEN:
+    _cfg = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
+    _cfg.connection_pool_maxsize = LINE_POOL_MAXSIZE
+    _API_CLIENT = ApiClient(_cfg)
+    _MESSAGING = MessagingApi(_API_CLIENT)
+    atexit.register(_API_CLIENT.close)  # 行程結束時收掉連線池
+
+parser = WebhookParser(CHANNEL_SECRET or "DUMMY_SECRET") if LINE_READY else None
+
+# 金鑰只排程一次；每個請求 copy() 已帶金鑰的 HMAC 狀態再餵 body
+_HMAC_BASE = hmac.new(SECRET_BYTES, digestmod=hashlib.sha256) if SECRET_BYTES else None
+
+def signature_ok(raw: bytes, signature: str) -> bool:
+    """以常數時間比對 X-Line-Signature；偽造請求在進 SDK 解析前就擋下。"""
+    if _HMAC_BASE is None:
+        return False
+    mac = _HMAC_BASE.copy()
+    mac.update(raw)
+    return hmac.compare_digest(base64.b64encode(mac.digest()), signature.encode("utf-8"))
 
-def make_api_client():
-    """沒有 token 就回 None，避免在回覆時拋錯。"""
-    if not (LINE_READY and CHANNEL_ACCESS_TOKEN):
-        return None
-    cfg = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
-    return ApiClient(cfg)
-
-handler = WebhookHandler(CHANNEL_SECRET or "DUMMY_SECRET") if LINE_READY else None
+# 健康檢查最常打的就是這裡：回應內容固定，先編好 bytes
+INDEX_BODY = b"Werewolf LINE Bot is running. POST /callback for webhook."
 
 @app.route("/", methods=["GET"])
 def index():
-    return "Werewolf LINE Bot is running. POST /callback for webhook.", 200
+    return INDEX_BODY, 200
+
+# ===== 依 key 排隊的背景工作：同一 key 依序執行，不同 key 可並行 =====
+class SerialQueues:
+    def __init__(self, executor: ThreadPoolExecutor, tag: str):
+        self._executor = executor
+        self._tag = tag
+        self._queues: dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, func, *args):
+        with self._lock:
+            q = self._queues.get(key)
+            if q is not None:
+                q.append((func, args))  # 已有 worker 在處理這個 key，排在後面即可
+                return
+            self._queues[key] = deque([(func, args)])
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key: str):
+        while True:
+            with self._lock:
+                q = self._queues[key]
+                if not q:
+                    del self._queues[key]
+                    return
+                func, args = q.popleft()
+            try:
+                func(*args)
+            except Exception as e:  # 一筆失敗不能卡住同 key 後面的工作
+                app.logger.exception(f"[{self._tag}] 背景工作失敗：{e}")
+
+# 事件處理丟到背景執行，webhook 驗完簽章就回 200，LINE 端不會因為我們打 API 慢而逾時重送；
+# 同一個聊天室的事件依抵達順序處理（例如先後兩次『投票』、『換』之後才『確認角色』）
+WEBHOOK_WORKERS = 8
+WEBHOOK_EXECUTOR = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="webhook")
+_INBOUND = SerialQueues(WEBHOOK_EXECUTOR, "CALLBACK")
+
+def _is_text_message(event) -> bool:
+    # 目前只處理文字訊息；加好友、貼圖、SDK 不認得的事件（UnknownEvent）都略過
+    return isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent)
 
 @app.route("/callback", methods=["POST"])
 def callback():
@@ -67,319 +125,645 @@ def callback():
         return "LINE SDK not ready", 200
 
     sig = request.headers.get("X-Line-Signature", "")
-    body = request.get_data(as_text=True)
+    raw = request.get_data(cache=False)
+    if not signature_ok(raw, sig):
+        app.logger.warning("[CALLBACK] 簽章不符（多半是 SECRET 錯或非 LINE 來源）")
+        abort(400)
     try:
-        handler.handle(body, sig)
+        events = parser.parse(raw.decode("utf-8"), sig)
     except InvalidSignatureError:
-        # SECRET 錯或非 LINE 來源
         app.logger.warning("[CALLBACK] InvalidSignatureError（多半是 SECRET 錯或非 LINE 來源）")
         abort(400)
     except Exception as e:
-        app.logger.exception(f"[CALLBACK] 例外：{e}")
-        return "error logged", 200
+        # 簽章對但內容解析不了：記 log 後照回 200，免得 LINE 一直重送同一批
+        app.logger.exception(f"[CALLBACK] webhook 內容解析失敗：{e}")
+        return "OK", 200
+    for event in events:
+        if _is_text_message(event):
+            _INBOUND.submit(get_room_id(event) or "", on_message, event)
     return "OK", 200
 
 # ====== 安全回覆工具 ======
-def reply_text(event, text: str):
-    client = make_api_client()
-    if not client:
-        app.logger.warning("[REPLY] 缺少 CHANNEL_ACCESS_TOKEN 或 LINE SDK 未就緒，無法回覆")
-        return
-    try:
-        with client as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=text)]
-                )
-            )
-    except Exception as e:
-        app.logger.exception(f"[REPLY] 回覆失敗：{e}")
+def _safe_api(tag: str, action: str):
+    """送訊息共用的防護：client 未就緒只記警告，API 例外記 log，都不往外拋；被包的函式第一個參數拿到 _MESSAGING。"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrap(*args):
+            if not _MESSAGING:
+                app.logger.warning(f"[{tag}] 缺少 CHANNEL_ACCESS_TOKEN 或 LINE SDK 未就緒，無法{action}")
+                return
+            try:
+                fn(_MESSAGING, *args)
+            except Exception as e:
+                app.logger.exception(f"[{tag}] {action}失敗：{e}")
+        return wrap
+    return deco
+
+@_safe_api("REPLY", "回覆")
+def reply_text(api, event, text: "str | TextMessage | list[str]"):
+    """text 可直接傳預先建好的 TextMessage（見 HELP_MSG）；傳 list 則一次回多則（LINE 上限 5 則）。
+
+    reply token 只能用一次，同一事件要回多段文字就一起傳進來。
+    """
+    items = text if isinstance(text, list) else [text]
+    api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[t if isinstance(t, TextMessage) else TextMessage(text=t) for t in items]
+        )
+    )
+
+# ===== 背景推送：push/multicast 交給執行緒池，webhook 不必等 LINE 回應 =====
+# reply 由 WEBHOOK_EXECUTOR 的 worker 在回 200 之後送出（reply token 仍有效）。
+# push_text 對同一收件者依序排隊；multicast 以整組收件者為 key，與個別 push 之間不保證先後
+PUSH_WORKERS = 16
+EXECUTOR = ThreadPoolExecutor(max_workers=PUSH_WORKERS, thread_name_prefix="line-push")
+_OUTBOUND = SerialQueues(EXECUTOR, "PUSH")
 
 def push_text(to_id: str, text: str):
-    client = make_api_client()
-    if not client:
-        app.logger.warning("[PUSH] 缺少 CHANNEL_ACCESS_TOKEN 或 LINE SDK 未就緒，無法推送")
+    _OUTBOUND.submit(to_id, _do_push, to_id, text)
+
+@_safe_api("PUSH", "推送")
+def _do_push(api, to_id: str, text: str):
+    api.push_message(PushMessageRequest(to=to_id, messages=[TextMessage(text=text)]))
+
+def push_many(uids: list[str], text: str):
+    """同一段文字推給多位玩家：多人走一次 multicast，單人退回 push。"""
+    if not uids:
         return
-    try:
-        with client as api_client:
-            MessagingApi(api_client).push_message(
-                PushMessageRequest(to=to_id, messages=[TextMessage(text=text)])
-            )
-    except Exception as e:
-        app.logger.exception(f"[PUSH] 推送失敗：{e}")
+    if len(uids) == 1:
+        push_text(uids[0], text)
+        return
+    _OUTBOUND.submit("multicast:" + ",".join(uids), _do_multicast, list(uids), text)
+
+@_safe_api("MULTICAST", "推送")
+def _do_multicast(api, uids: list[str], text: str):
+    api.multicast(MulticastRequest(to=uids, messages=[TextMessage(text=text)]))
 
 def get_room_id(event):
-    s = event.source
-    return getattr(s, "group_id", None) or getattr(s, "room_id", None) or s.user_id
+    s = getattr(event, "source", None)
+    return getattr(s, "group_id", None) or getattr(s, "room_id", None) or getattr(s, "user_id", None)
 
 def get_user_id(event):
     return event.source.user_id
 
+# ====== 小型 TTL 快取（執行緒安全；不另裝 cachetools）======
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl: float | None = None):
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._data) >= self.maxsize:
+                del self._data[next(iter(self._data))]  # 淘汰最早寫入的一筆
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+
+    def add(self, key, value=True) -> bool:
+        """key 不存在（或已過期）才寫入並回 True；檢查與寫入在同一把鎖內。"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] > time.monotonic():
+                return False
+            self._data.pop(key, None)
+            if len(self._data) >= self.maxsize:
+                del self._data[next(iter(self._data))]
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            return True
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+# 顯示名稱快取：(room_id, user_id) → 名稱；改名約一小時內生效
+# 查詢失敗（例如沒加好友）記成空字串，只留一分鐘，加好友後很快就能拿到本名
+NAME_CACHE_TTL = 3600
+NAME_FAIL_TTL = 60
+_NAME_CACHE = TTLCache(maxsize=4096, ttl=NAME_CACHE_TTL)
+
 def get_display_name(room_id: str | None, user_id: str) -> str:
-    try:
-        client = make_api_client()
-        if not client:
+    key = (room_id, user_id)
+    name = _NAME_CACHE.get(key)
+    if name is None:
+        if not _MESSAGING:
+            return "玩家"
+        try:
+            name = _fetch_display_name(room_id, user_id)
+            _NAME_CACHE.set(key, name)
+        except ApiException as e:
+            app.logger.info(f"[PROFILE] 取不到 {user_id} 的名稱（HTTP {e.status}），先用預設名稱")
+            name = ""
+            _NAME_CACHE.set(key, name, ttl=NAME_FAIL_TTL)
+        except Exception as e:
+            app.logger.exception(f"[PROFILE] 取名稱失敗：{e}")
             return "玩家"
-        with client as api_client:
-            api = MessagingApi(api_client)
-            if room_id and room_id != user_id:
-                prof = api.get_group_member_profile(room_id, user_id)
-            else:
-                prof = api.get_profile(user_id)
-            return prof.display_name
-    except Exception:
-        return "玩家"
-
-def now_utc():
-    return datetime.now(timezone.utc)
+    return name or "玩家"
+
+def _fetch_display_name(room_id: str | None, user_id: str) -> str:
+    if room_id and room_id != user_id:
+        prof = _MESSAGING.get_group_member_profile(room_id, user_id)
+    else:
+        prof = _MESSAGING.get_profile(user_id)
+    return prof.display_name
 
 # ============== 遊戲資料與規則 ==============
 MIN_P, MAX_P = 5, 8
 WOLF_COUNT_BY_N = {5: 1, 6: 2, 7: 2, 8: 2}
 NIGHT_MINUTES = int(os.getenv("NIGHT_MINUTES", "6"))
 DAY_MINUTES = int(os.getenv("DAY_MINUTES", "8"))
+NIGHT_DELTA = timedelta(minutes=NIGHT_MINUTES)
+DAY_DELTA = timedelta(minutes=DAY_MINUTES)
+
+# 角色用 StrEnum：本身就是中文字串，可直接顯示、寫進 JSON、與玩家輸入比對
+class Role(StrEnum):
+    WOLF = "狼人"
+    SEER = "預言家"
+    DOCTOR = "醫生"
+    WITCH = "女巫"
+    HUNTER = "獵人"
+    VILLAGER = "村民"
+
+WOLF, SEER, DOCTOR, WITCH, HUNTER, VILLAGER = (
+    Role.WOLF, Role.SEER, Role.DOCTOR, Role.WITCH, Role.HUNTER, Role.VILLAGER
+)
 
 ROLE_DESCRIPTIONS = {
-    "狼人": "狼人｜夜晚可商議並擊殺一名玩家（『私訊』：擊殺 名字）。",
-    "村民": "村民｜無主動技能，靠發言與投票。",
-    "預言家": "預言家｜夜晚可查驗一名玩家是否為狼人（『私訊』：查驗 名字，每晚一次）。",
-    "醫生": "醫生｜夜晚可救一名玩家（『私訊』：救 名字；自救全局僅一次；不得連續兩晚救同一人）。",
-    "女巫": "女巫｜擁有解藥與毒藥各一次（『私訊』：解救／投毒 名字）。解救僅能救當晚狼刀對象，且不得自救。",
-    "獵人": "獵人｜被淘汰後可『私訊』：開槍 名字（帶走一人，一次）。",
+    WOLF: "狼人｜夜晚可商議並擊殺一名玩家（『私訊』：擊殺 名字）。",
+    VILLAGER: "村民｜無主動技能，靠發言與投票。",
+    SEER: "預言家｜夜晚可查驗一名玩家是否為狼人（『私訊』：查驗 名字，每晚一次）。",
+    DOCTOR: "醫生｜夜晚可救一名玩家（『私訊』：救 名字；自救全局僅一次；不得連續兩晚救同一人）。",
+    WITCH: "女巫｜擁有解藥與毒藥各一次（『私訊』：解救／投毒 名字）。解救僅能救當晚狼刀對象，且不得自救。",
+    HUNTER: "獵人｜被淘汰後可『私訊』：開槍 名字（帶走一人，一次）。",
 }
 
 class Player:
+    __slots__ = ("user_id", "name", "role", "alive")
+
     def __init__(self, uid: str, name: str):
         self.user_id = uid
         self.name = name
-        self.role: str | None = None
+        self.role: Role | None = None
         self.alive: bool = True
 
+    def to_dict(self) -> dict:
+        return {"user_id": self.user_id, "name": self.name, "role": self.role, "alive": self.alive}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Player":
+        p = cls(d["user_id"], d["name"])
+        p.role = Role(d["role"]) if d["role"] else None
+        p.alive = d["alive"]
+        return p
+
+class NightFlags:
+    """夜晚技能狀態；跨夜保留的（用藥、自救、上一晚救誰）與每晚歸零的放在一起。"""
+    __slots__ = (
+        "seer_done_uids",
+        "doctor_saved_uid", "doctor_selfheal_used", "doctor_last_saved_uid",
+        "witch_heal_left", "witch_poison_left", "witch_save_flag", "witch_poison_uid", "witch_uid",
+    )
+
+    def __init__(self):
+        # 預言家
+        self.seer_done_uids: set[str] = set()
+        # 醫生
+        self.doctor_saved_uid: str | None = None
+        self.doctor_selfheal_used: set[str] = set()
+        self.doctor_last_saved_uid: str | None = None
+        # 女巫
+        self.witch_heal_left: bool = True
+        self.witch_poison_left: bool = True
+        self.witch_save_flag: bool = False
+        self.witch_poison_uid: str | None = None
+        self.witch_uid: str | None = None
+
+    def to_dict(self) -> dict:
+        d = {k: getattr(self, k) for k in self.__slots__}
+        d["seer_done_uids"] = list(self.seer_done_uids)
+        d["doctor_selfheal_used"] = list(self.doctor_selfheal_used)
+        return d
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "NightFlags":
+        nf = cls()
+        for k in cls.__slots__:
+            if k in d:
+                setattr(nf, k, d[k])
+        nf.seer_done_uids = set(nf.seer_done_uids)
+        nf.doctor_selfheal_used = set(nf.doctor_selfheal_used)
+        return nf
+
+    def reset_per_night(self):
+        self.seer_done_uids.clear()
+        self.doctor_last_saved_uid = self.doctor_saved_uid
+        self.doctor_saved_uid = None
+        self.witch_save_flag = False
+        self.witch_poison_uid = None
+
 class GameRoom:
+    __slots__ = (
+        "room_id", "host_id", "players", "started", "phase",
+        "base_roles", "current_roles", "role_index",
+        "votes", "wolf_targets", "nf", "hunter_pending_uid",
+        "deadline_mono", "timer_id", "by_name",
+        "n_wolves_alive", "n_good_alive", "lock",
+    )
+
     def __init__(self, room_id: str, host_id: str):
         self.room_id = room_id
         self.host_id = host_id
         self.players: dict[str, Player] = {}
+        self.by_name: dict[str, Player] = {}  # 名字 → 玩家；房內名字唯一
         self.started: bool = False
         self.phase: str = "waiting"  # waiting → config → night → day
 
-        self.base_roles: list[str] = []
-        self.current_roles: list[str] = []
+        self.base_roles: list[Role] = []
+        self.current_roles: list[Role] = []
+        self.role_index: dict[Role, list[str]] = {}  # 發牌後：角色 → user_id 列表
+        # 存活人數（發牌時設定，之後只經由 eliminate() 遞減）
+        self.n_wolves_alive: int = 0
+        self.n_good_alive: int = 0
 
         self.votes: dict[str, str] = {}
         self.wolf_targets: list[str] = []
 
-        self.night_flags = {
-            # 預言家
-            "seer_done_uids": set(),
-            # 醫生
-            "doctor_saved_uid": None,
-            "doctor_selfheal_used": set(),
-            "doctor_last_saved_uid": None,
-            # 女巫
-            "witch_heal_left": True,
-            "witch_poison_left": True,
-            "witch_save_flag": False,
-            "witch_poison_uid": None,
-            "witch_uid": None,
-        }
+        self.nf = NightFlags()
 
         self.hunter_pending_uid: str | None = None
 
         # 自動結算相關
-        self.deadline_at = None
-        self.n_job_id = None
-        self.d_job_id = None
+        self.deadline_mono: float | None = None  # time.monotonic() 到期點，只拿來算剩餘秒數
+        self.timer_id: int | None = None  # TimerLoop token
+
+        # webhook 執行緒與計時執行緒都會改同一房；所有變更都要先拿這把鎖
+        self.lock = threading.RLock()
+
+    # ===== Redis 快照（JSON）：by_name、鎖、計時 token 都是執行期狀態，讀回時重建 =====
+    SNAPSHOT_FIELDS = (
+        "room_id", "host_id", "started", "phase",
+        "base_roles", "current_roles", "role_index",
+        "votes", "wolf_targets", "hunter_pending_uid",
+        "n_wolves_alive", "n_good_alive",
+    )
 
-    def alive_players(self):
-        return [p for p in self.players.values() if p.alive]
+    def to_dict(self) -> dict:
+        d = {k: getattr(self, k) for k in self.SNAPSHOT_FIELDS}
+        d["players"] = [p.to_dict() for p in self.players.values()]
+        d["nf"] = self.nf.to_dict()
+        # monotonic 時間換了行程就沒意義，改存牆上時間，重啟後據此重排倒數
+        d["deadline_epoch"] = (
+            time.time() + (self.deadline_mono - time.monotonic())
+            if self.deadline_mono is not None else None
+        )
+        return d
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "GameRoom":
+        room = cls(d["room_id"], d["host_id"])
+        for k in cls.SNAPSHOT_FIELDS:
+            setattr(room, k, d[k])
+        room.base_roles = [Role(r) for r in room.base_roles]
+        room.current_roles = [Role(r) for r in room.current_roles]
+        room.role_index = {Role(r): uids for r, uids in room.role_index.items()}
+        for pd in d["players"]:
+            p = Player.from_dict(pd)
+            room.players[p.user_id] = p
+            room.by_name[p.name] = p
+        room.nf = NightFlags.from_dict(d["nf"])
+        return room
+
+    def add_player(self, player: Player):
+        # LINE 顯示名稱可能撞名：後加入的自動補編號（小明 → 小明2），指令點名才不會含糊
+        base, n = player.name, 2
+        while player.name in self.by_name:
+            player.name = f"{base}{n}"
+            n += 1
+        self.players[player.user_id] = player
+        self.by_name[player.name] = player
+
+    def remove_player(self, uid: str) -> Player | None:
+        p = self.players.pop(uid, None)
+        if p is not None and self.by_name.get(p.name) is p:
+            del self.by_name[p.name]
+        return p
+
+    def name_taken(self, name: str, player: Player) -> bool:
+        other = self.by_name.get(name)
+        return other is not None and other is not player
+
+    def rename(self, player: Player, new_name: str):
+        self.by_name.pop(player.name, None)
+        player.name = new_name
+        self.by_name[new_name] = player
+
+    def find_alive(self, name: str) -> Player | None:
+        p = self.by_name.get(name)
+        return p if p is not None and p.alive else None
 
 ROOMS: dict[str, GameRoom] = {}
+USER_ROOM: dict[str, GameRoom] = {}  # user_id → 所在房間，私訊指令 O(1) 找房
+_LOBBY_LOCK = threading.RLock()  # 房間還不存在時（建房／加入新房）用這把
+
+def room_lock(room: GameRoom | None):
+    return room.lock if room else _LOBBY_LOCK
 
 # ============== 角色模板與換角 ==============
-def build_base_roles(n: int) -> list[str]:
+def build_base_roles(n: int) -> list[Role]:
     wolves = WOLF_COUNT_BY_N.get(n, max(1, n // 4))
-    roles = ["狼人"] * wolves + ["預言家", "醫生"]
-    while len(roles) < n:
-        roles.append("村民")
-    return roles
-
-def pretty_roles(roles: list[str]) -> str:
-    c = Counter(roles)
-    order = ["狼人", "預言家", "醫生", "女巫", "獵人", "村民"]
-    parts = []
-    for r in order:
-        if c[r]:
-            parts.append(f"{r}×{c[r]}")
-    for r, v in c.items():
-        if r not in order:
-            parts.append(f"{r}×{v}")
-    return "、".join(parts) if parts else "（空）"
-
-def swap_doctor_to_witch(roles: list[str]) -> tuple[bool, str]:
-    if "女巫" in roles:
+    return [WOLF] * wolves + [SEER, DOCTOR] + [VILLAGER] * (n - wolves - 2)
+
+ROLE_ORDER = (WOLF, SEER, DOCTOR, WITCH, HUNTER, VILLAGER)
+ROLE_RANK = {r: i for i, r in enumerate(ROLE_ORDER)}
+
+def pretty_roles(roles: list[Role]) -> str:
+    # 依固定順序排一次即可；不在表上的角色排最後（sorted 穩定，維持出現順序）
+    items = sorted(Counter(roles).items(), key=lambda kv: ROLE_RANK.get(kv[0], len(ROLE_ORDER)))
+    return "、".join(f"{r}×{n}" for r, n in items) or "（空）"
+
+def swap_doctor_to_witch(roles: list[Role]) -> tuple[bool, str]:
+    if WITCH in roles:
         return False, "已有『女巫』，無法再換。"
-    if "醫生" not in roles:
+    if DOCTOR not in roles:
         return False, "模板中沒有『醫生』可供替換。"
-    idx = roles.index("醫生")
-    roles[idx] = "女巫"
+    idx = roles.index(DOCTOR)
+    roles[idx] = WITCH
     return True, "已將『醫生』替換為『女巫』。"
 
-def swap_villager_to_hunter(roles: list[str]) -> tuple[bool, str]:
-    if "獵人" in roles:
+def swap_villager_to_hunter(roles: list[Role]) -> tuple[bool, str]:
+    if HUNTER in roles:
         return False, "已有『獵人』，無法再換。"
-    if "村民" not in roles:
+    if VILLAGER not in roles:
         return False, "模板中沒有『村民』可供替換。"
-    idx = roles.index("村民")
-    roles[idx] = "獵人"
+    idx = roles.index(VILLAGER)
+    roles[idx] = HUNTER
     return True, "已將一名『村民』替換為『獵人』。"
 
 def role_intro_text() -> str:
     lines = ["📚 角色清單（名稱｜能力）"]
-    for k in ["狼人", "預言家", "醫生", "女巫", "獵人", "村民"]:
+    for k in ROLE_ORDER:
         if k in ROLE_DESCRIPTIONS:
             lines.append(ROLE_DESCRIPTIONS[k])
     return "\n".join(lines)
 
-def assign_and_notify(room: GameRoom, roles: list[str]):
-    uids = list(room.players.keys())
-    random.shuffle(uids)
-    random.shuffle(roles)
-    for uid, r in zip(uids, roles):
+def assign_and_notify(room: GameRoom):
+    # 只需打亂角色一邊即為均勻發牌；sample 直接回新串列，不動 current_roles
+    dealt = random.sample(room.current_roles, len(room.current_roles))
+    room.role_index = {}
+    for uid, r in zip(room.players, dealt):
         room.players[uid].role = r
-        if r == "女巫":
-            room.night_flags["witch_uid"] = uid
+        room.role_index.setdefault(r, []).append(uid)
+    room.n_wolves_alive = len(room.role_index.get(WOLF, []))
+    room.n_good_alive = len(dealt) - room.n_wolves_alive
+    witches = room.role_index.get(WITCH)
+    if witches:
+        room.nf.witch_uid = witches[0]
+
+    # 同角色的身份訊息相同，直接整組 multicast；狼人收到的是同一份完整狼隊名單
+    for r, role_uids in room.role_index.items():
+        text = f"你的身份是：{r}"
+        if r == WOLF:
+            text += "\n狼人陣營：" + "、".join(room.players[uid].name for uid in role_uids)
+        push_many(role_uids, text)
+
+def eliminate(room: GameRoom, p: Player):
+    """淘汰玩家的唯一入口：同步更新存活人數，讓終局判定不必重掃。"""
+    if not p.alive:
+        return
+    p.alive = False
+    if p.role == WOLF:
+        room.n_wolves_alive -= 1
+    else:
+        room.n_good_alive -= 1
 
-    wolves = [p for p in room.players.values() if p.role == "狼人"]
-    wolf_names = [w.name for w in wolves]
-    for p in room.players.values():
-        msg = f"你的身份是：{p.role}"
-        if p.role == "狼人":
-            mates = [n for n in wolf_names if n != p.name]
-            msg += "\n你的同伴：" + ("、".join(mates) if mates else "（無）")
-        push_text(p.user_id, msg)
-
-def check_game_end(room: GameRoom, announce_event=None) -> bool:
-    alive = room.alive_players()
-    wolves = [p for p in alive if p.role == "狼人"]
-    good = [p for p in alive if p.role != "狼人"]
-
-    if not wolves:
+def announce(room: GameRoom, replies: list[str] | None, text: str):
+    """replies 是 list 時先收集，由呼叫端最後一次 reply；否則直接推播到群組。"""
+    if replies is None:
+        push_text(room.room_id, text)
+    else:
+        replies.append(text)
+
+def check_game_end(room: GameRoom, replies: list[str] | None = None) -> bool:
+    if not room.n_wolves_alive:
         msg = "🎉 遊戲結束：好人獲勝！"
-    elif len(wolves) >= len(good):
+    elif room.n_wolves_alive >= room.n_good_alive:
         msg = "💀 遊戲結束：狼人獲勝！"
     else:
         return False
 
-    if announce_event:
-        reply_text(announce_event, msg)
-    else:
-        push_text(room.room_id, msg)
+    announce(room, replies, msg)
 
     clear_schedules(room)
-    ROOMS.pop(room.room_id, None)
+    drop_room(room)
     return True
 
+def drop_room(room: GameRoom):
+    # 同群組可能已重新建房：只移除仍指向這個物件的項目
+    if ROOMS.get(room.room_id) is room:
+        del ROOMS[room.room_id]
+    for uid in room.players:
+        if USER_ROOM.get(uid) is room:
+            USER_ROOM.pop(uid, None)
+
+def pick_top(picks: list[str]) -> str | None:
+    """取最高票者；同票隨機挑一位，沒有票回 None。"""
+    if not picks:
+        return None
+    # 最常見的情況：只有一隻狼、或大家選同一人，不必建 Counter
+    first = picks[0]
+    if all(x == first for x in picks):
+        return first
+    ranked = Counter(picks).most_common()
+    top = ranked[0][1]
+    tied = [uid for uid, _ in takewhile(lambda kv: kv[1] == top, ranked)]
+    return random.choice(tied)
+
 def ensure_in_room(uid: str) -> GameRoom | None:
-    for r in ROOMS.values():
-        if uid in r.players:
-            return r
-    return None
+    return USER_ROOM.get(uid)
 
-# ============== 簡易排程器（無 APScheduler 時用） ==============
-class SimpleScheduler:
-    def __init__(self):
-        self._jobs = {}
+# ============== 房間持久化（Redis write-through） ==============
+ROOM_KEY_PREFIX = "werewolf:room:"
+# 快照存活時間：兩個最長階段；每次指令都會重寫並續期，放著不玩的房間自己過期
+ROOM_TTL = 2 * max(NIGHT_MINUTES, DAY_MINUTES) * 60
 
-    def add_job(self, func, trigger, run_date, args, id, replace_existing=True):
-        delay = max(0, (run_date - now_utc()).total_seconds())
-        t = threading.Timer(delay, func, args=args)
-        if replace_existing and id in self._jobs:
-            try:
-                self._jobs[id].cancel()
-            except Exception:
-                pass
-        self._jobs[id] = t
-        t.daemon = True
-        t.start()
-        return type("Job", (), {"id": id})
-
-    def remove_job(self, id):
-        t = self._jobs.pop(id, None)
-        if t:
-            t.cancel()
-
-# 建立 scheduler
-if USE_APS:
+def persist_room(room_id: str | None):
+    """房間還在就寫入快照，已結束/重置就刪除；沒有 Redis 時什麼都不做。"""
+    if not _REDIS or not room_id:
+        return
+    room = ROOMS.get(room_id)
     try:
-        scheduler = BackgroundScheduler()
-        scheduler.start()
+        if room:
+            snap = room.to_dict()
+            ttl = ROOM_TTL
+            if snap["deadline_epoch"]:  # 『延長』過的長倒數也要涵蓋
+                ttl += max(0, int(snap["deadline_epoch"] - time.time()))
+            _REDIS.setex(ROOM_KEY_PREFIX + room_id, ttl, json.dumps(snap, ensure_ascii=False))
+        else:
+            _REDIS.delete(ROOM_KEY_PREFIX + room_id)
     except Exception as e:
-        print(f"[BOOT] APScheduler 啟動失敗，改用 SimpleScheduler：{e}")
-        USE_APS = False
-        scheduler = SimpleScheduler()
-else:
-    scheduler = SimpleScheduler()
+        app.logger.exception(f"[REDIS] 寫入房間 {room_id} 失敗：{e}")
+
+def load_rooms():
+    """啟動時從 Redis 讀回所有房間，重建 user_id 索引，並把夜/日倒數接著排回去。"""
+    if not _REDIS:
+        return
+    try:
+        for key in _REDIS.scan_iter(ROOM_KEY_PREFIX + "*"):
+            data = _REDIS.get(key)
+            if not data:
+                continue
+            try:
+                snap = json.loads(data)
+                room = GameRoom.from_dict(snap)
+            except (ValueError, KeyError, TypeError) as e:
+                # 舊格式（pickle）或壞掉的快照：直接丟掉，不讓它擋住其他房間
+                print(f"[BOOT] 略過無法解析的房間快照 {key!r}：{e}")
+                _REDIS.delete(key)
+                continue
+            ROOMS[room.room_id] = room
+            for uid in room.players:
+                USER_ROOM[uid] = room
+            if room.phase in ("night", "day") and snap.get("deadline_epoch"):
+                left = max(0.0, snap["deadline_epoch"] - time.time())  # 停機期間已到期就立刻結算
+                job = night_timeout_job if room.phase == "night" else day_timeout_job
+                arm_phase_timer(room, timedelta(seconds=left), job)
+        print(f"[BOOT] 從 Redis 載入 {len(ROOMS)} 個房間")
+    except Exception as e:
+        print(f"[BOOT] 從 Redis 載入房間失敗：{e}")
+
+# ============== 排程器：單一背景執行緒 + 最小堆積 ==============
+class TimerLoop:
+    """所有房間的夜/日倒數共用一條執行緒，依到期時間排在 heapq 裡。
+
+    call_later 回傳整數 token，房間只記 token；cancel 只是把 token 從表中拿掉，
+    留在堆積裡的舊項目到頂時直接略過。已交給執行緒池的工作 cancel 不到，
+    需要的話先用 new_token() 取號、把 token 一起傳給工作，由工作自己比對。
+    計時執行緒只負責等時間到，到期的工作交給執行緒池跑：工作要等房間鎖，
+    而拿著鎖的 webhook 可能正卡在 LINE／Redis 的網路呼叫，不能讓一房拖住所有房的倒數。
+    """
+    def __init__(self):
+        self._heap: list[tuple[float, int]] = []  # (到期 monotonic 秒, token)
+        self._jobs: dict[int, tuple] = {}  # token → (func, args)
+        self._seq = itertools.count(1)
+        self._cv = threading.Condition()
+        threading.Thread(target=self._run, name="phase-timer", daemon=True).start()
+
+    def new_token(self) -> int:
+        with self._cv:
+            return next(self._seq)
+
+    def call_later(self, delay: float, func, *args, token: int | None = None) -> int:
+        with self._cv:
+            if token is None:
+                token = next(self._seq)
+            self._jobs[token] = (func, args)
+            heapq.heappush(self._heap, (time.monotonic() + max(0.0, delay), token))
+            self._cv.notify()
+        return token
+
+    def cancel(self, token: int | None):
+        if token is None:
+            return
+        with self._cv:
+            self._jobs.pop(token, None)
+
+    def _next_due(self):
+        with self._cv:
+            while True:
+                if not self._heap:
+                    self._cv.wait()
+                    continue
+                run_at, token = self._heap[0]
+                if token not in self._jobs:
+                    heapq.heappop(self._heap)  # 已取消
+                    continue
+                delay = run_at - time.monotonic()
+                if delay > 0:
+                    self._cv.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                return self._jobs.pop(token)
+
+    def _run(self):
+        while True:
+            func, args = self._next_due()
+            WEBHOOK_EXECUTOR.submit(self._call, func, args)
+
+    @staticmethod
+    def _call(func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            app.logger.exception(f"[TIMER] 排程工作失敗：{e}")
+
+scheduler = TimerLoop()
 
 # ============== 自動結算（夜/日） ==============
+def arm_phase_timer(room: GameRoom, delta: timedelta, job):
+    """同一時間只有一個階段在倒數：換階段時取消舊計時，掛上新的。"""
+    scheduler.cancel(room.timer_id)
+    seconds = delta.total_seconds()
+    room.deadline_mono = time.monotonic() + seconds
+    # 先記下 token 再排程；工作拿到鎖後比對 token，被取代的舊倒數即使已經出發也不會結算
+    room.timer_id = scheduler.new_token()
+    scheduler.call_later(seconds, job, room.room_id, room.timer_id, token=room.timer_id)
+
+# 預設時長直接用模組層的 NIGHT_DELTA / DAY_DELTA，只有『延長』才另建 timedelta
 def schedule_night_timeout(room: GameRoom, minutes=None):
-    minutes = minutes or NIGHT_MINUTES
-    if room.n_job_id:
-        try: scheduler.remove_job(room.n_job_id)
-        except Exception: pass
-    room.deadline_at = now_utc() + timedelta(minutes=minutes)
-    job = scheduler.add_job(
-        func=night_timeout_job,
-        trigger='date',
-        run_date=room.deadline_at,
-        args=[room.room_id],
-        id=f"night-{room.room_id}",
-        replace_existing=True
-    )
-    room.n_job_id = job.id
+    if not minutes:
+        minutes, delta = NIGHT_MINUTES, NIGHT_DELTA
+    else:
+        delta = timedelta(minutes=minutes)
+    arm_phase_timer(room, delta, night_timeout_job)
     push_text(room.room_id, f"🌙 夜晚開始（{minutes} 分鐘）。到時自動結算。")
 
 def schedule_day_timeout(room: GameRoom, minutes=None):
-    minutes = minutes or DAY_MINUTES
-    if room.d_job_id:
-        try: scheduler.remove_job(room.d_job_id)
-        except Exception: pass
-    room.deadline_at = now_utc() + timedelta(minutes=minutes)
-    job = scheduler.add_job(
-        func=day_timeout_job,
-        trigger='date',
-        run_date=room.deadline_at,
-        args=[room.room_id],
-        id=f"day-{room.room_id}",
-        replace_existing=True
-    )
-    room.d_job_id = job.id
+    if not minutes:
+        minutes, delta = DAY_MINUTES, DAY_DELTA
+    else:
+        delta = timedelta(minutes=minutes)
+    arm_phase_timer(room, delta, day_timeout_job)
     push_text(room.room_id, f"🌞 白天開始（{minutes} 分鐘）。到時自動結算。")
 
 def clear_schedules(room: GameRoom):
-    for jid in (room.n_job_id, room.d_job_id):
-        if jid:
-            try: scheduler.remove_job(jid)
-            except Exception: pass
-    room.n_job_id = room.d_job_id = None
-    room.deadline_at = None
-
-def night_timeout_job(room_id: str):
+    scheduler.cancel(room.timer_id)
+    room.timer_id = None
+    room.deadline_mono = None
+
+# 結算函式自己會掛上下一階段的倒數，這裡不必再排
+def night_timeout_job(room_id: str, token: int):
     room = ROOMS.get(room_id)
-    if not room or room.phase != "night":
+    if not room:
         return
-    resolve_night_and_start_day(room, event=None)
-    if room and room.phase == "day":
-        schedule_day_timeout(room)
+    with room.lock:
+        # 拿到鎖前可能已被手動結算、『延長』換了新倒數，或房間已重置（甚至同群組已重新建房）
+        if ROOMS.get(room_id) is not room or room.timer_id != token or room.phase != "night":
+            return
+        resolve_night_and_start_day(room, event=None)
+        persist_room(room_id)
 
-def day_timeout_job(room_id: str):
+def day_timeout_job(room_id: str, token: int):
     room = ROOMS.get(room_id)
-    if not room or room.phase != "day":
+    if not room:
         return
-    auto_endday(room)
-    if room and room.phase == "night":
-        schedule_night_timeout(room)
+    with room.lock:
+        if ROOMS.get(room_id) is not room or room.timer_id != token or room.phase != "day":
+            return
+        auto_endday(room)
+        persist_room(room_id)
 
 def extend_current_phase(room: GameRoom, add_minutes: int):
     if room.phase == "night":
@@ -387,33 +771,35 @@ def extend_current_phase(room: GameRoom, add_minutes: int):
     elif room.phase == "day":
         schedule_day_timeout(room, minutes=add_minutes)
 
-def force_settle(room: GameRoom):
+def force_settle(room: GameRoom, event=None):
     if room.phase == "night":
-        resolve_night_and_start_day(room, event=None)
-        if room and room.phase == "day":
-            schedule_day_timeout(room)
+        resolve_night_and_start_day(room, event)
     elif room.phase == "day":
         auto_endday(room)
-        if room and room.phase == "night":
-            schedule_night_timeout(room)
 
 # ============== 指令（中文） ==============
+HELP_TEXT = (
+    "📜 指令列表（中文）\n"
+    "・建房／加入／暱稱 你的名字／狀態／角色清單／重置\n"
+    "・開始 → 產生預設模板 → 房主可『換 女巫 / 換 獵人』 → 『確認角色』發牌\n"
+    "・夜晚（請私訊機器人）：\n"
+    "   狼人：擊殺 名字\n"
+    "   預言家：查驗 名字（每晚一次）\n"
+    "   醫生：救 名字（每晚一次；自救全局一次；不得連續兩晚救同一人）\n"
+    "   女巫：解救（只能救當晚刀口且不得自救；一次）／投毒 名字（一次）\n"
+    "・白天：投票 名字 → 結算（放逐最高票）\n"
+    "・自動結算：夜/日皆有倒數；可『延長 分鐘數』或『立即結算』"
+)
+
+# 固定內容的回覆先建好 TextMessage，每次回覆不必重新建 pydantic 物件
+HELP_MSG = TextMessage(text=HELP_TEXT) if LINE_READY else None
+ROLE_LIST_MSG = TextMessage(text=role_intro_text()) if LINE_READY else None
+
 def cmd_help(event):
-    reply_text(event,
-        "📜 指令列表（中文）\n"
-        "・建房／加入／暱稱 你的名字／狀態／角色清單／重置\n"
-        "・開始 → 產生預設模板 → 房主可『換 女巫 / 換 獵人』 → 『確認角色』發牌\n"
-        "・夜晚（請私訊機器人）：\n"
-        "   狼人：擊殺 名字\n"
-        "   預言家：查驗 名字（每晚一次）\n"
-        "   醫生：救 名字（每晚一次；自救全局一次；不得連續兩晚救同一人）\n"
-        "   女巫：解救（只能救當晚刀口且不得自救；一次）／投毒 名字（一次）\n"
-        "・白天：投票 名字 → 結算（放逐最高票）\n"
-        "・自動結算：夜/日皆有倒數；可『延長 分鐘數』或『立即結算』"
-    )
+    reply_text(event, HELP_MSG)
 
 def cmd_rolelist(event):
-    reply_text(event, role_intro_text())
+    reply_text(event, ROLE_LIST_MSG)
 
 def cmd_build(event):
     rid, uid = get_room_id(event), get_user_id(event)
@@ -443,9 +829,33 @@ def cmd_join(event):
     if len(room.players) >= MAX_P:
         reply_text(event, f"人數已滿（{MAX_P}）。")
         return
-    # 預設用 LINE 顯示名稱加入；玩家可再輸入「暱稱 你的名字」變更
-    room.players[uid] = Player(uid, default_name)
-    reply_text(event, f"🙋 {default_name} 加入！目前人數：{len(room.players)}\n（若要更改暱稱，請輸入：暱稱 你的名字）")
+    other = USER_ROOM.get(uid)
+    if other is not None and not leave_unstarted_room(other, uid):
+        reply_text(event, "你已在其他房間的遊戲中，無法同時加入。")
+        return
+    # 預設用 LINE 顯示名稱加入（撞名會補編號）；玩家可再輸入「暱稱 你的名字」變更
+    player = Player(uid, default_name)
+    room.add_player(player)
+    USER_ROOM[uid] = room
+    reply_text(event, f"🙋 {player.name} 加入！目前人數：{len(room.players)}\n（若要更改暱稱，請輸入：暱稱 你的名字）")
+
+def leave_unstarted_room(other: GameRoom, uid: str) -> bool:
+    """加入新房時把玩家移出還沒開局的舊房；舊房已開局（或一時拿不到它的鎖）就回 False。"""
+    # 呼叫端已拿著新房的鎖；舊房鎖只限時等待，兩人互相跨房加入時才不會互卡
+    if not other.lock.acquire(timeout=2):
+        return False
+    try:
+        if other.started:
+            return False
+        p = other.remove_player(uid)
+        if USER_ROOM.get(uid) is other:
+            del USER_ROOM[uid]
+        if p is not None:
+            push_text(other.room_id, f"👋 {p.name} 已離開，改加入其他房間。目前人數：{len(other.players)}")
+        persist_room(other.room_id)
+        return True
+    finally:
+        other.lock.release()
 
 def cmd_set_nickname(event, nickname: str):
     """設定玩家暱稱：加入後即可於群/私訊輸入『暱稱 XXX』變更名稱。"""
@@ -459,16 +869,19 @@ def cmd_set_nickname(event, nickname: str):
         reply_text(event, "你尚未加入本局，請先輸入「加入」。")
         return
 
-    nickname = nickname.strip()
+    # on_message 已整句 strip 再 split(maxsplit=1)，參數前後不會有空白，不必再 strip
     if not nickname:
         reply_text(event, "用法：暱稱 你的名字（不可為空）")
         return
+    if room.name_taken(nickname, room.players[uid]):
+        reply_text(event, f"『{nickname}』已有人使用，請換一個暱稱。")
+        return
 
     # 取得該使用者目前的 LINE 顯示名稱（原名）
     line_name = get_display_name(rid, uid)
 
     # 更新玩家暱稱
-    room.players[uid].name = nickname
+    room.rename(room.players[uid], nickname)
 
     # 依你的需求：回覆「原本LINE名稱：變動後的暱稱」
     reply_text(event, f"{line_name}：{nickname}")
@@ -514,9 +927,9 @@ def cmd_swap(event, target: str):
         reply_text(event, "現在不是換角階段。")
         return
 
-    if target == "女巫":
+    if target == WITCH:
         ok, msg = swap_doctor_to_witch(room.current_roles)
-    elif target == "獵人":
+    elif target == HUNTER:
         ok, msg = swap_villager_to_hunter(room.current_roles)
     else:
         reply_text(event, "只能換『女巫』或『獵人』。")
@@ -543,12 +956,9 @@ def cmd_confirm_roles(event):
     room.started = True
     room.phase = "night"
     room.wolf_targets = []
-    room.night_flags["seer_done_uids"] = set()
-    room.night_flags["doctor_saved_uid"] = None
-    room.night_flags["witch_save_flag"] = False
-    room.night_flags["witch_poison_uid"] = None
+    room.nf.reset_per_night()
 
-    assign_and_notify(room, room.current_roles.copy())
+    assign_and_notify(room)
     reply_text(event,
         "🎲 已發牌！\n"
         f"本局角色：{pretty_roles(room.current_roles)}\n"
@@ -567,9 +977,8 @@ def cmd_status(event):
         reply_text(event, "尚未建房或房已結束。")
         return
     left = None
-    if room.deadline_at:
-        sec = int((room.deadline_at - now_utc()).total_seconds())
-        left = max(0, sec)
+    if room.deadline_mono is not None:
+        left = max(0, int(room.deadline_mono - time.monotonic()))
     lines = [
         f"📋 狀態：phase={room.phase}",
         f"玩家數：{len(room.players)}",
@@ -591,7 +1000,10 @@ def cmd_reset(event):
         reply_text(event, "僅建房者可重置。")
         return
     clear_schedules(room)
-    ROOMS.pop(rid, None)
+    drop_room(room)
+    # 重置後重新加入時重抓名稱，改過 LINE 名稱的人不必等快取過期
+    for p_uid in room.players:
+        _NAME_CACHE.pop((rid, p_uid))
     reply_text(event, "🔁 已重置房間。")
 
 def cmd_extend(event, minutes: int):
@@ -615,85 +1027,78 @@ def cmd_force(event):
     if uid != room.host_id:
         reply_text(event, "僅房主可立即結算。")
         return
-    force_settle(room)
+    force_settle(room, event)
 
 # ============== 夜晚私訊技能 ==============
-def pm_kill(uid: str, text: str):
+def pm_kill(uid: str, target_name: str):
     room = ensure_in_room(uid)
     if not room or not room.started or room.phase != "night":
         push_text(uid, "現在不是夜晚，或你未在房間。")
         return
     me = room.players[uid]
-    if not (me.alive and me.role == "狼人"):
+    if not (me.alive and me.role == WOLF):
         push_text(uid, "只有存活的狼人可行動。")
         return
-    parts = text.split(maxsplit=1)
-    if len(parts) != 2:
+    if not target_name:
         push_text(uid, "用法：擊殺 名字")
         return
-    target_name = parts[1].strip()
-    cands = [p for p in room.alive_players() if p.name == target_name]
-    if not cands:
+    target = room.find_alive(target_name)
+    if target is None:
         push_text(uid, f"找不到活著的「{target_name}」。")
         return
-    room.wolf_targets.append(cands[0].user_id)
+    room.wolf_targets.append(target.user_id)
     push_text(uid, f"已提名刀：{target_name}（待結算）")
 
-def pm_seer(uid: str, text: str):
+def pm_seer(uid: str, target_name: str):
     room = ensure_in_room(uid)
     if not room or not room.started or room.phase != "night":
         push_text(uid, "現在不是夜晚，或你未在房間。")
         return
     me = room.players[uid]
-    if not (me.alive and me.role == "預言家"):
+    if not (me.alive and me.role == SEER):
         push_text(uid, "只有存活的『預言家』可行動。")
         return
-    if uid in room.night_flags["seer_done_uids"]:
+    if uid in room.nf.seer_done_uids:
         push_text(uid, "本晚已查驗過了。")
         return
-    parts = text.split(maxsplit=1)
-    if len(parts) != 2:
+    if not target_name:
         push_text(uid, "用法：查驗 名字")
         return
-    target_name = parts[1].strip()
-    cands = [p for p in room.alive_players() if p.name == target_name]
-    if not cands:
+    target = room.find_alive(target_name)
+    if target is None:
         push_text(uid, f"找不到活著的「{target_name}」。")
         return
-    room.night_flags["seer_done_uids"].add(uid)
-    result = "狼人" if cands[0].role == "狼人" else "非狼人"
+    room.nf.seer_done_uids.add(uid)
+    result = "狼人" if target.role == WOLF else "非狼人"
     push_text(uid, f"查驗結果：{target_name} 是 {result}")
 
-def pm_doctor(uid: str, text: str):
+def pm_doctor(uid: str, target_name: str):
     room = ensure_in_room(uid)
     if not room or not room.started or room.phase != "night":
         push_text(uid, "現在不是夜晚，或你未在房間。")
         return
     me = room.players[uid]
-    if not (me.alive and me.role == "醫生"):
+    if not (me.alive and me.role == DOCTOR):
         push_text(uid, "只有存活的『醫生』可行動。")
         return
-    parts = text.split(maxsplit=1)
-    if len(parts) != 2:
+    if not target_name:
         push_text(uid, "用法：救 名字")
         return
-    target_name = parts[1].strip()
-    cands = [p for p in room.players.values() if p.alive and p.name == target_name]
-    if not cands:
+    target = room.find_alive(target_name)
+    if target is None:
         push_text(uid, f"找不到活著的「{target_name}」。")
         return
-    target = cands[0]
     # 不得連續兩晚救同一人
-    if room.night_flags["doctor_last_saved_uid"] == target.user_id:
+    if room.nf.doctor_last_saved_uid == target.user_id:
         push_text(uid, "不得連續兩晚救同一人。")
         return
     # 自救全局一次
-    if target.user_id == uid and uid in room.night_flags["doctor_selfheal_used"]:
+    if target.user_id == uid and uid in room.nf.doctor_selfheal_used:
         push_text(uid, "你的自救次數已用完。")
         return
-    room.night_flags["doctor_saved_uid"] = target.user_id
+    room.nf.doctor_saved_uid = target.user_id
     if target.user_id == uid:
-        room.night_flags["doctor_selfheal_used"].add(uid)
+        room.nf.doctor_selfheal_used.add(uid)
     push_text(uid, f"已標記救援：{target.name}")
 
 def pm_witch_heal(uid: str):
@@ -702,58 +1107,53 @@ def pm_witch_heal(uid: str):
         push_text(uid, "現在不是夜晚，或你未在房間。")
         return
     me = room.players[uid]
-    if not (me.alive and me.role == "女巫"):
+    if not (me.alive and me.role == WITCH):
         push_text(uid, "只有存活的『女巫』可行動。")
         return
-    if not room.night_flags["witch_heal_left"]:
+    if not room.nf.witch_heal_left:
         push_text(uid, "你的解藥已用完。")
         return
     # 只標記本晚用了解藥；實際救誰在結算時計算狼刀目標
-    room.night_flags["witch_save_flag"] = True
+    room.nf.witch_save_flag = True
     push_text(uid, "已使用『解救』（僅對當晚刀口生效，且不得自救）。")
 
-def pm_witch_poison(uid: str, text: str):
+def pm_witch_poison(uid: str, target_name: str):
     room = ensure_in_room(uid)
     if not room or not room.started or room.phase != "night":
         push_text(uid, "現在不是夜晚，或你未在房間。")
         return
     me = room.players[uid]
-    if not (me.alive and me.role == "女巫"):
+    if not (me.alive and me.role == WITCH):
         push_text(uid, "只有存活的『女巫』可行動。")
         return
-    if not room.night_flags["witch_poison_left"]:
+    if not room.nf.witch_poison_left:
         push_text(uid, "你的毒藥已用完。")
         return
-    parts = text.split(maxsplit=1)
-    if len(parts) != 2:
+    if not target_name:
         push_text(uid, "用法：投毒 名字")
         return
-    target_name = parts[1].strip()
-    cands = [p for p in room.alive_players() if p.name == target_name]
-    if not cands:
+    target = room.find_alive(target_name)
+    if target is None:
         push_text(uid, f"找不到活著的「{target_name}」。")
         return
-    room.night_flags["witch_poison_uid"] = cands[0].user_id
+    room.nf.witch_poison_uid = target.user_id
     push_text(uid, f"已標記『投毒』對象：{target_name}")
 
-def pm_hunter_shoot(uid: str, text: str):
+def pm_hunter_shoot(uid: str, target_name: str):
     room = ensure_in_room(uid)
     if not room:
         return
     if room.hunter_pending_uid != uid:
         push_text(uid, "你目前無法開槍。")
         return
-    parts = text.split(maxsplit=1)
-    if len(parts) != 2:
+    if not target_name:
         push_text(uid, "用法：開槍 名字")
         return
-    target_name = parts[1].strip()
-    cands = [p for p in room.alive_players() if p.name == target_name]
-    if not cands:
+    victim = room.find_alive(target_name)
+    if victim is None:
         push_text(uid, f"找不到活著的「{target_name}」。")
         return
-    victim = cands[0]
-    victim.alive = False
+    eliminate(room, victim)
     room.hunter_pending_uid = None
     push_text(room.room_id, f"🔫 獵人開槍：{victim.name} 被帶走。")
     if check_game_end(room):
@@ -762,76 +1162,61 @@ def pm_hunter_shoot(uid: str, text: str):
 # ============== 夜晚結算 → 白天 ==============
 def resolve_night_and_start_day(room: GameRoom, event=None):
     # 1) 狼人票選刀口
-    wolf_target_uid = None
-    if room.wolf_targets:
-        tally = Counter(room.wolf_targets)
-        maxv = max(tally.values())
-        tied = [uid for uid, v in tally.items() if v == maxv]
-        wolf_target_uid = random.choice(tied)
+    wolf_target_uid = pick_top(room.wolf_targets)
 
     # 2) 醫生救人（覆蓋狼刀）
-    if room.night_flags["doctor_saved_uid"] == wolf_target_uid:
+    if room.nf.doctor_saved_uid == wolf_target_uid:
         wolf_target_uid = None  # 被救
 
     # 3) 女巫解藥（僅救當晚刀口；不得自救）
-    if room.night_flags["witch_save_flag"] and room.night_flags["witch_heal_left"]:
+    if room.nf.witch_save_flag and room.nf.witch_heal_left:
         if wolf_target_uid is not None:
-            witch_uid = room.night_flags["witch_uid"]
+            witch_uid = room.nf.witch_uid
             if wolf_target_uid != witch_uid:
                 wolf_target_uid = None
-                room.night_flags["witch_heal_left"] = False
+                room.nf.witch_heal_left = False
 
     # 4) 女巫毒藥
     poison_uid = None
-    if room.night_flags["witch_poison_uid"] and room.night_flags["witch_poison_left"]:
-        poison_uid = room.night_flags["witch_poison_uid"]
-        room.night_flags["witch_poison_left"] = False
-
-    # 死亡名單
-    deaths = []
-    if wolf_target_uid:
-        p = room.players.get(wolf_target_uid)
-        if p and p.alive:
-            p.alive = False
-            deaths.append(p)
-    if poison_uid and (poison_uid != wolf_target_uid):
-        p = room.players.get(poison_uid)
-        if p and p.alive:
-            p.alive = False
-            deaths.append(p)
-
-    # 獵人待開槍
-    for p in deaths:
-        if p.role == "獵人":
+    if room.nf.witch_poison_uid and room.nf.witch_poison_left:
+        poison_uid = room.nf.witch_poison_uid
+        room.nf.witch_poison_left = False
+
+    # 死亡名單（刀口與毒同一人只算一次）＋獵人待開槍，一趟處理完
+    death_names = []
+    for uid in dict.fromkeys(u for u in (wolf_target_uid, poison_uid) if u):
+        p = room.players.get(uid)
+        if not (p and p.alive):
+            continue
+        eliminate(room, p)
+        death_names.append(p.name)
+        if p.role == HUNTER:
             room.hunter_pending_uid = p.user_id
             push_text(p.user_id, "你被淘汰了！可『私訊』輸入：開槍 名字（一次）。")
 
-    # 公告
-    if deaths:
-        msg = "🌞 天亮了！昨晚淘汰：" + "、".join(p.name for p in deaths)
+    # 公告：房主『立即結算』時整段併成一次 reply（reply token 只能用一次），計時到期則推播
+    replies = [] if event else None
+    if death_names:
+        announce(room, replies, "🌞 天亮了！昨晚淘汰：" + "、".join(death_names))
     else:
-        msg = "🌞 天亮了！昨晚是平安夜。"
-    if event: reply_text(event, msg)
-    else: push_text(room.room_id, msg)
+        announce(room, replies, "🌞 天亮了！昨晚是平安夜。")
 
     # 清空當晚狀態
     room.wolf_targets = []
-    room.night_flags["seer_done_uids"] = set()
-    room.night_flags["doctor_last_saved_uid"] = room.night_flags["doctor_saved_uid"]
-    room.night_flags["doctor_saved_uid"] = None
-    room.night_flags["witch_save_flag"] = False
-    room.night_flags["witch_poison_uid"] = None
+    room.nf.reset_per_night()
 
     # 終局判定
-    if check_game_end(room, event):
+    if check_game_end(room, replies):
+        if replies:
+            reply_text(event, replies)
         return
 
     # 進入白天＋倒數
     room.phase = "day"
+    announce(room, replies, "請討論並『投票 名字』，時間到自動『結算』放逐最高票。")
+    if replies:
+        reply_text(event, replies)
     schedule_day_timeout(room)
-    tip = "請討論並『投票 名字』，時間到自動『結算』放逐最高票。"
-    if event: reply_text(event, tip)
-    else: push_text(room.room_id, tip)
 
 # ============== 白天：投票與結算 ==============
 def auto_endday(room: GameRoom):
@@ -840,16 +1225,13 @@ def auto_endday(room: GameRoom):
         room.phase = "night"
         schedule_night_timeout(room)
         return
-    tally = Counter(room.votes.values())
-    maxv = max(tally.values())
-    losers = [uid for uid, v in tally.items() if v == maxv]
-    victim_uid = random.choice(losers)
+    victim_uid = pick_top(list(room.votes.values()))
     victim = room.players[victim_uid]
-    victim.alive = False
+    eliminate(room, victim)
     room.votes.clear()
     push_text(room.room_id, f"📢 白天結算：{victim.name} 被放逐。")
 
-    if victim.role == "獵人":
+    if victim.role == HUNTER:
         room.hunter_pending_uid = victim.user_id
         push_text(victim.user_id, "你被淘汰了！可『私訊』輸入：開槍 名字（一次）。")
 
@@ -872,11 +1254,11 @@ def cmd_vote(event, target_name: str):
     if voter not in room.players or not room.players[voter].alive:
         reply_text(event, "你未參與本局或已出局，不能投票。")
         return
-    cands = [p for p in room.alive_players() if p.name == target_name]
-    if not cands:
+    target = room.find_alive(target_name)
+    if target is None:
         reply_text(event, f"找不到活著的「{target_name}」。")
         return
-    room.votes[voter] = cands[0].user_id
+    room.votes[voter] = target.user_id
     reply_text(event, f"✅ 已投票給：{target_name}")
 
 def cmd_endday(event):
@@ -891,75 +1273,133 @@ def cmd_endday(event):
     auto_endday(room)
 
 # ============== 事件處理 ==============
+def on_witch_heal(uid: str, _arg: str):
+    # 解救不帶目標；與其他私訊技能同一張表，才能照 USER_ROOM 找房、拿房間鎖並寫回快照
+    pm_witch_heal(uid)
+
+def on_nickname(event, arg: str):
+    if arg:
+        cmd_set_nickname(event, arg)
+    else:
+        reply_text(event, "用法：暱稱 你的名字")
+
+def on_swap(event, arg: str):
+    if arg:
+        cmd_swap(event, arg)
+    else:
+        reply_text(event, "用法：換 女巫／換 獵人")
+
+def on_vote(event, arg: str):
+    if arg:
+        cmd_vote(event, arg)
+    else:
+        reply_text(event, "用法：投票 名字（例：投票 小明）")
+
+# \d 只認十進位數字（含全形「２」），int() 一定吃得下；isdigit() 則會放行「²」之類的字
+MINUTES_RE = re.compile(r"\d{1,3}")
+
+def on_extend(event, arg: str):
+    if MINUTES_RE.fullmatch(arg):
+        cmd_extend(event, int(arg))
+    else:
+        reply_text(event, "用法：延長 分鐘數（例：延長 2）")
+
+# 重播/重送防護：過舊的事件或處理過的 webhookEventId 直接略過，
+# 避免 LINE 逾時重送或惡意重播讓「投票」「加入」被套用兩次
+EVENT_MAX_AGE_MS = 5 * 60 * 1000
+_SEEN_EVENTS = TTLCache(maxsize=10_000, ttl=600)
+
+def is_replayed(event) -> bool:
+    ts = getattr(event, "timestamp", None)
+    if ts and ts < time.time() * 1000 - EVENT_MAX_AGE_MS:
+        return True
+    eid = getattr(event, "webhook_event_id", None)
+    return bool(eid) and not _SEEN_EVENTS.add(eid)
+
+# 私訊技能：第一個詞 → 處理函式(uid, 目標名字)
+PM_COMMANDS = {
+    "擊殺": pm_kill,
+    "查驗": pm_seer,
+    "救": pm_doctor,
+    "投毒": pm_witch_poison,
+    "開槍": pm_hunter_shoot,
+    "解救": on_witch_heal,
+}
+
+# 群組/私訊中文指令：整句完全相符 → 處理函式(event)
+COMMANDS = {
+    "幫助": cmd_help,
+    "角色清單": cmd_rolelist,
+    "建房": cmd_build,
+    "加入": cmd_join,
+    "狀態": cmd_status,
+    "重置": cmd_reset,
+    "開始": cmd_start,
+    "確認角色": cmd_confirm_roles,
+    "結算": cmd_endday,
+    "立即結算": cmd_force,  # 房主工具
+}
+
+# 尚未建房時仍會回應的指令；其餘訊息在沒開局的群組直接略過
+ROOMLESS_COMMANDS = frozenset({"幫助", "角色清單", "建房", "加入"})
+
+# 帶參數的指令：第一個詞 → 處理函式(event, 參數)
+ARG_COMMANDS = {
+    "暱稱": on_nickname,
+    "換": on_swap,
+    "投票": on_vote,
+    "延長": on_extend,  # 房主工具
+}
+
 if LINE_READY:
-    @handler.add(MessageEvent, message=TextMessageContent)
     def on_message(event: MessageEvent):
+        if is_replayed(event):
+            app.logger.info("[CALLBACK] 略過重送/過期事件")
+            return
         text = (event.message.text or "").strip()
-
-        # 私訊技能
-        if text.startswith("擊殺"):
-            pm_kill(get_user_id(event), text); return
-        if text.startswith("查驗"):
-            pm_seer(get_user_id(event), text); return
-        if text.startswith("救"):
-            pm_doctor(get_user_id(event), text); return
-        if text == "解救":
-            pm_witch_heal(get_user_id(event)); return
-        if text.startswith("投毒"):
-            pm_witch_poison(get_user_id(event), text); return
-        if text.startswith("開槍"):
-            pm_hunter_shoot(get_user_id(event), text); return
-
-        # 群組/私訊中文指令
-        if text == "幫助": cmd_help(event); return
-        if text == "角色清單": cmd_rolelist(event); return
-        if text == "建房": cmd_build(event); return
-
-        # 加入 & 暱稱
-        if text == "加入": cmd_join(event); return
-        if text.startswith("暱稱"):
-            parts = text.split(maxsplit=1)
-            if len(parts) == 2 and parts[1].strip():
-                cmd_set_nickname(event, parts[1].strip()); return
-            reply_text(event, "用法：暱稱 你的名字"); return
-
-        if text == "狀態": cmd_status(event); return
-        if text == "重置": cmd_reset(event); return
-
-        if text == "開始": cmd_start(event); return
-        if text == "確認角色": cmd_confirm_roles(event); return
-        if text.startswith("換"):
-            parts = text.split(maxsplit=1)
-            if len(parts) == 2:
-                cmd_swap(event, parts[1].strip())
-            else:
-                reply_text(event, "用法：換 女巫／換 獵人")
+        parts = text.split(maxsplit=1)
+        if not parts:
             return
-
-        if text.startswith("投票"):
-            parts = text.split(maxsplit=1)
-            if len(parts) == 2: cmd_vote(event, parts[1].strip())
-            else: reply_text(event, "用法：投票 名字（例：投票 小明）")
+        head = parts[0]
+        arg = parts[1] if len(parts) == 2 else ""
+
+        pm = PM_COMMANDS.get(head)
+        if pm:
+            uid = get_user_id(event)
+            room = ensure_in_room(uid)
+            with room_lock(room):
+                pm(uid, arg)
+                persist_room(room.room_id if room else None)
             return
 
-        if text == "結算":
-            cmd_endday(event); return
+        rid = get_room_id(event)
+        room = ROOMS.get(rid)
+        if room is None and text not in ROOMLESS_COMMANDS:
+            return
 
-        # 房主工具
-        if text.startswith("延長"):
-            parts = text.split()
-            if len(parts) == 2 and parts[1].isdigit():
-                cmd_extend(event, int(parts[1])); return
-            reply_text(event, "用法：延長 分鐘數（例：延長 2）"); return
+        cmd = COMMANDS.get(text)
+        if cmd:
+            with room_lock(room):
+                cmd(event)
+                persist_room(rid)
+            return
 
-        if text == "立即結算":
-            cmd_force(event); return
+        arg_cmd = ARG_COMMANDS.get(head)
+        if arg_cmd:
+            with room_lock(room):
+                arg_cmd(event, arg)
+                persist_room(rid)
+            return
 
         # 默認不回覆，避免干擾群聊
         return
 
+# ============== 啟動：從 Redis 還原房間（排程器與指令都已定義） ==============
+load_rooms()
+
 # ============== 本機測試入口 ==============
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "5000"))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    # 只給本機測試；正式環境走 gunicorn。要 reloader／除錯器請自行設 FLASK_DEBUG=1
+    app.run(host="0.0.0.0", port=port, debug=os.getenv("FLASK_DEBUG") == "1", threaded=True)
 
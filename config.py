@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+"""app.py 與 FlaskWebhook.py 共用的環境設定（.env 載入與 LINE 金鑰）。"""
+import os
+
+# ===== 可選：載入 Render Secret Files 的 .env =====
+SECRET_FILE_PATH = "/etc/secrets/.env"  # 若未使用可忽略；如有不同路徑請修改
+
+# 環境變數若已在 Render → Environment 設定，就不必再開檔解析 .env（省冷啟動）
+if "CHANNEL_SECRET" not in os.environ:
+    try:
+        from dotenv import load_dotenv
+        if os.path.exists(SECRET_FILE_PATH):
+            load_dotenv(SECRET_FILE_PATH)
+        else:
+            load_dotenv()
+    except Exception:
+        pass  # 不因 dotenv 失敗而終止
+
+CHANNEL_SECRET = os.getenv("CHANNEL_SECRET")
+CHANNEL_ACCESS_TOKEN = os.getenv("CHANNEL_ACCESS_TOKEN")
+SECRET_BYTES = CHANNEL_SECRET.encode("utf-8") if CHANNEL_SECRET else None
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+"""gunicorn 設定（Procfile：gunicorn -c gunicorn.conf.py app:app）。"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# 房間與倒數都在行程記憶體裡，只支援 1 個 worker，靠 gthread 執行緒處理並發。
+# 設了 REDIS_URL 也不能多開：快照只在啟動時載入一次，各 worker 的 ROOMS 會各自走樣，
+# 而且每個 worker 都會重掛同一批倒數，同一階段會被結算好幾次
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "gthread"
+threads = 8  # 請求執行緒只驗簽章、排進佇列；打 LINE API 的是 app.py 的 WEBHOOK_EXECUTOR 與 EXECUTOR
+
+# keep-alive 要比前端負載平衡器的閒置逾時長，連線才不會被我們先關掉
+keepalive = 75
+timeout = 60
+
+loglevel = "debug"
+capture_output = True
+errorlog = "-"
+accesslog = "-"